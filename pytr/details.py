@@ -1,6 +1,18 @@
 import asyncio
+import sys
 from pytr.utils import preview
 from datetime import datetime, timedelta
+from itertools import chain
+
+# subscription type -> attribute the response is stored in
+TYPE_TO_ATTR = {
+    'stockDetails': 'stockDetails',
+    'neonNews': 'neonNews',
+    'ticker': 'ticker',
+    'performance': 'performance',
+    'instrument': 'instrument',
+    'instrumentSuitability': 'instrumentSuitability',
+}
 
 
 class Details:
@@ -9,83 +21,87 @@ class Details:
         self.isin = isin
 
     async def details_loop(self):
-        recv = 0
+        # the first subscription opens the websocket, the others can be sent concurrently
         await self.tr.stock_details(self.isin)
-        await self.tr.news(self.isin)
-        # await self.tr.subscribe_news(self.isin)
-        await self.tr.ticker(self.isin, exchange='LSX')
-        await self.tr.performance(self.isin, exchange='LSX')
-        await self.tr.instrument_details(self.isin)
-        await self.tr.instrument_suitability(self.isin)
+        await asyncio.gather(
+            self.tr.news(self.isin),
+            # self.tr.subscribe_news(self.isin),
+            self.tr.ticker(self.isin, exchange='LSX'),
+            self.tr.performance(self.isin, exchange='LSX'),
+            self.tr.instrument_details(self.isin),
+            self.tr.instrument_suitability(self.isin),
+        )
 
         # await self.tr.add_watchlist(self.isin)
         # await self.tr.remove_watchlist(self.isin)
         # await self.tr.savings_plan_parameters(self.isin)
         # await self.tr.unsubscribe_news(self.isin)
 
+        received = set()
         while True:
             _subscription_id, subscription, response = await self.tr.recv()
 
-            if subscription['type'] == 'stockDetails':
-                recv += 1
-                self.stockDetails = response
-            elif subscription['type'] == 'neonNews':
-                recv += 1
-                self.neonNews = response
-            elif subscription['type'] == 'ticker':
-                recv += 1
-                self.ticker = response
-            elif subscription['type'] == 'performance':
-                recv += 1
-                self.performance = response
-            elif subscription['type'] == 'instrument':
-                recv += 1
-                self.instrument = response
-            elif subscription['type'] == 'instrumentSuitability':
-                recv += 1
-                self.instrumentSuitability = response
-                print('instrumentSuitability:', response)
-            else:
+            attr = TYPE_TO_ATTR.get(subscription['type'])
+            if attr is None:
                 print(f"unmatched subscription of type '{subscription['type']}':\n{preview(response, num_lines=30)}")
+                continue
+
+            setattr(self, attr, response)
+            received.add(attr)
+            if attr == 'instrumentSuitability':
+                print('instrumentSuitability:', response)
 
-            if recv == 6:
+            if len(received) == len(TYPE_TO_ATTR):
                 return
 
-    def print_instrument(self):
-        print('Name:', self.instrument['name'])
-        print('ShortName:', self.instrument['shortName'])
-        print('Type:', self.instrument['typeId'])
+    def _instrument_lines(self):
+        yield f"Name: {self.instrument['name']}"
+        yield f"ShortName: {self.instrument['shortName']}"
+        yield f"Type: {self.instrument['typeId']}"
         for ex in self.instrument['exchanges']:
-            print(f"{ex['slug']}: {ex['symbolAtExchange']} {ex['nameAtExchange']}")
+            yield f"{ex['slug']}: {ex['symbolAtExchange']} {ex['nameAtExchange']}"
 
         for tag in self.instrument['tags']:
-            print(f"{tag['type']}: {tag['name']}")
+            yield f"{tag['type']}: {tag['name']}"
 
-    def stock_details(self):
+    def _stock_details_lines(self):
         company = self.stockDetails['company']
         for company_detail in company:
             if company[company_detail] is not None:
-                print(f'{company_detail:15}: {company[company_detail]}')
+                yield f'{company_detail:15}: {company[company_detail]}'
         for detail in self.stockDetails:
             if detail != 'company' and self.stockDetails[detail] is not None and self.stockDetails[detail] != []:
-                print(f'{detail:15}: {self.stockDetails[detail]}')
+                yield f'{detail:15}: {self.stockDetails[detail]}'
 
-    def news(self, relevant_days=30):
-        since = datetime.now() - timedelta(days=relevant_days)
+    def _news_lines(self, relevant_days=30):
         if not hasattr(self, 'neonNews'):
             return
+        # compare the raw millisecond timestamps, only convert the relevant ones
+        since_ms = (datetime.now() - timedelta(days=relevant_days)).timestamp() * 1000
         for news in self.neonNews:
-            newsdate = datetime.fromtimestamp(news['createdAt'] / 1000.0)
-            if newsdate > since:
+            if news['createdAt'] > since_ms:
+                newsdate = datetime.fromtimestamp(news['createdAt'] / 1000.0)
                 dateiso = newsdate.isoformat(sep=' ', timespec='minutes')
-                print(f"{dateiso}: {news['headline']}")
+                yield f"{dateiso}: {news['headline']}"
+
+    @staticmethod
+    def _write_lines(lines):
+        # one write instead of a print per line, which is slow on line buffered terminals
+        sys.stdout.write(''.join(f'{line}\n' for line in lines))
+
+    def print_instrument(self):
+        self._write_lines(self._instrument_lines())
+
+    def stock_details(self):
+        self._write_lines(self._stock_details_lines())
+
+    def news(self, relevant_days=30):
+        self._write_lines(self._news_lines(relevant_days))
 
     def overview(self):
-        self.print_instrument()
-        self.news()
-        self.stock_details()
+        self._write_lines(chain(self._instrument_lines(), self._news_lines(), self._stock_details_lines()))
 
     def get(self):
-        asyncio.get_event_loop().run_until_complete(self.details_loop())
+        asyncio.run(self.details_loop())
 
         self.overview()
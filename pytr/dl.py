@@ -1,15 +1,36 @@
+import aiofiles
+import aiohttp
+import asyncio
+import certifi
+import functools
+import heapq
+import itertools
 import re
+import sqlite3
+import ssl
+import time
 
-from concurrent.futures import as_completed
 from pathlib import Path
-from requests_futures.sessions import FuturesSession
-from requests import session
 
 from pathvalidate import sanitize_filepath
 
 from pytr.utils import preview, Timeline, get_logger
 from pytr.api import TradeRepublicError
 
+# HTTP status codes of failed downloads that are worth retrying
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+MAX_TRIES = 5
+# seconds to wait before the first retry, doubled on every further retry
+RETRY_BACKOFF = 1.0
+# size of the chunks written to disk while a document is downloaded
+CHUNK_SIZE = 64 * 1024
+# text file with one URL per line used for the history by older versions
+LEGACY_HISTORY_FILE = 'pytr_history'
+# time of day in the subtitle of a document, e.g. 'um 10:15 Uhr'
+TIME_RE = re.compile(r'um (\d+:\d+) Uhr')
+# remove newlines and replace slashes in titles used for file names
+SANITIZE_TABLE = str.maketrans({'\n': None, '/': '-'})
+
 
 class DL:
     def __init__(
@@ -18,7 +39,7 @@ class DL:
         output_path,
         filename_fmt,
         since_timestamp=0,
-        history_file='pytr_history',
+        history_file='pytr_history.db',
         max_workers=8,
         universal_filepath=False,
     ):
@@ -35,37 +56,75 @@ class DL:
         self.since_timestamp = since_timestamp
         self.universal_filepath = universal_filepath
 
-        requests_session = session()
         if self.tr._weblogin:
-            requests_session.headers = self.tr._default_headers_web
+            self.headers = self.tr._default_headers_web
         else:
-            requests_session.headers = self.tr._default_headers
-        self.session = FuturesSession(max_workers=max_workers, session=requests_session)
-        self.futures = []
+            self.headers = self.tr._default_headers
+        self.max_workers = max_workers
+        # the client session is created in dl_loop because it has to be bound to the running event loop
+        self._http = None
+        # download jobs: (doc_url, doc_url_base, filepath, try_count)
+        self._queue = asyncio.Queue()
+        # heap of jobs waiting for a retry: (retry_date, seq, job)
+        self._retries = []
+        self._retry_seq = itertools.count()
+        self._retry_added = asyncio.Event()
+        self._workers = []
 
         self.docs_request = 0
         self.done = 0
-        self.filepaths = []
-        self.doc_urls = []
-        self.doc_urls_history = []
+        self.filepaths = set()
+        self.doc_urls = set()
         self.tl = Timeline(self.tr)
+        # subscription type -> handler of the response
+        self._handlers = {
+            'timelineTransactions': self.tl.get_next_timeline_transactions,
+            'timelineActivityLog': self.tl.get_next_timeline_activity_log,
+            'timelineDetailV2': functools.partial(self.tl.timelineDetail, dl=self),
+        }
         self.log = get_logger(__name__)
         self.load_history()
 
     def load_history(self):
         '''
-        Read history file with URLs if it exists, otherwise create empty file
+        Open history database with URLs, create it if it doesn't exist.
+        URLs from an old text history file are imported once when the database is created.
         '''
-        if self.history_file.exists():
-            with self.history_file.open() as f:
-                self.doc_urls_history = f.read().splitlines()
-            self.log.info(f'Found {len(self.doc_urls_history)} lines in history file')
+        created = not self.history_file.exists()
+        self.history_file.parent.mkdir(exist_ok=True, parents=True)
+        self._db = sqlite3.connect(self.history_file)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        # without rowid the URLs are stored only once, in the primary key index
+        self._db.execute('CREATE TABLE IF NOT EXISTS downloaded(url TEXT PRIMARY KEY) WITHOUT ROWID')
+
+        legacy_history_file = self.output_path / LEGACY_HISTORY_FILE
+        if created and legacy_history_file.is_file():
+            with legacy_history_file.open() as f:
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO downloaded(url) VALUES (?)', ((line.rstrip('\n'),) for line in f)
+                )
+            self.log.info(f'Imported {legacy_history_file} into history database')
+        self._db.commit()
+
+        if created:
+            self.log.info('Created history database')
         else:
-            self.history_file.parent.mkdir(exist_ok=True, parents=True)
-            self.history_file.touch()
-            self.log.info('Created history file')
+            (count,) = self._db.execute('SELECT COUNT(*) FROM downloaded').fetchone()
+            self.log.info(f'Found {count} URLs in history database')
+
+    def in_history(self, doc_url_base):
+        return self._db.execute('SELECT 1 FROM downloaded WHERE url = ?', (doc_url_base,)).fetchone() is not None
 
     async def dl_loop(self):
+        # use the certifi CA bundle like requests did and like the websocket connection does
+        ssl_context = ssl.create_default_context(cafile=certifi.where())
+        self._http = aiohttp.ClientSession(
+            headers=self.headers,
+            connector=aiohttp.TCPConnector(limit=self.max_workers, keepalive_timeout=30, ssl=ssl_context),
+        )
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_workers)]
+        self._workers.append(asyncio.create_task(self._reaper()))
         await self.tl.get_next_timeline_transactions(max_age_timestamp=self.since_timestamp)
 
         while True:
@@ -74,18 +133,15 @@ class DL:
             except TradeRepublicError as e:
                 self.log.fatal(str(e))
 
-            if subscription['type'] == 'timelineTransactions':
-                await self.tl.get_next_timeline_transactions(response, max_age_timestamp=self.since_timestamp)
-            elif subscription['type'] == 'timelineActivityLog':
-                await self.tl.get_next_timeline_activity_log(response, max_age_timestamp=self.since_timestamp)
-            elif subscription['type'] == 'timelineDetailV2':
-                await self.tl.timelineDetail(response, self, max_age_timestamp=self.since_timestamp)
+            handler = self._handlers.get(subscription['type'])
+            if handler is not None:
+                await handler(response, max_age_timestamp=self.since_timestamp)
             else:
                 self.log.warning(f"unmatched subscription of type '{subscription['type']}':\n{preview(response)}")
 
     def dl_doc(self, doc, titleText, subtitleText, subfolder=None):
         '''
-        send asynchronous request, append future with filepath to self.futures
+        put download job for the document into the download queue
         '''
         doc_url = doc['action']['payload']
         if subtitleText is None:
@@ -101,13 +157,10 @@ class DL:
 
         # extract time from subtitleText
         try:
-            time = re.findall('um (\\d+:\\d+) Uhr', subtitleText)
-            if time == []:
-                time = ''
-            else:
-                time = f' {time[0]}'
+            match = TIME_RE.search(subtitleText)
         except TypeError:
-            time = ''
+            match = None
+        time_fmt = f' {match.group(1)}' if match else ''
 
         if subfolder is not None:
             directory = self.output_path / subfolder
@@ -122,11 +175,11 @@ class DL:
             doc_type_num = ''
 
         doc_type = ' '.join(doc_type)
-        titleText = titleText.replace('\n', '').replace('/', '-')
-        subtitleText = subtitleText.replace('\n', '').replace('/', '-')
+        titleText = titleText.translate(SANITIZE_TABLE)
+        subtitleText = subtitleText.translate(SANITIZE_TABLE)
 
         filename = self.filename_fmt.format(
-            iso_date=iso_date, time=time, title=titleText, subtitle=subtitleText, doc_num=doc_type_num, id=doc_id
+            iso_date=iso_date, time=time_fmt, title=titleText, subtitle=subtitleText, doc_num=doc_type_num, id=doc_id
         )
 
         filename_with_doc_id = filename + f' ({doc_id})'
@@ -153,54 +206,112 @@ class DL:
             else:
                 filepath = filepath_with_doc_id
         doc['local filepath'] = str(filepath)
-        self.filepaths.append(filepath)
+        self.filepaths.add(filepath)
 
         if filepath.is_file() is False:
             doc_url_base = doc_url.split('?')[0]
             if doc_url_base in self.doc_urls:
                 self.log.debug(f'URL {doc_url_base} already in queue. Skipping...')
                 return
-            elif doc_url_base in self.doc_urls_history:
+            elif self.in_history(doc_url_base):
                 self.log.debug(f'URL {doc_url_base} already in history. Skipping...')
                 return
             else:
-                self.doc_urls.append(doc_url_base)
+                self.doc_urls.add(doc_url_base)
 
-            future = self.session.get(doc_url)
-            future.filepath = filepath
-            future.doc_url_base = doc_url_base
-            self.futures.append(future)
+            self._queue.put_nowait((doc_url, doc_url_base, filepath, 1))
             self.log.debug(f'Added {filepath} to queue')
         else:
             self.log.debug(f'file {filepath} already exists. Skipping...')
 
-    def work_responses(self):
+    async def _worker(self):
         '''
-        process responses of async requests
+        take jobs from the download queue until cancelled
         '''
-        if len(self.doc_urls) == 0:
-            self.log.info('Nothing to download')
-            exit(0)
+        while True:
+            job = await self._queue.get()
+            doc_url, doc_url_base, filepath, try_count = job
+            try:
+                await self._fetch(doc_url, doc_url_base, filepath)
+            except aiohttp.ClientResponseError as e:
+                if e.status in RETRY_STATUS and try_count < MAX_TRIES:
+                    backoff = RETRY_BACKOFF * 2 ** (try_count - 1)
+                    self.log.debug(f'Got status {e.status} for {filepath.name}. Retry #{try_count} in {backoff}s')
+                    retry_job = (doc_url, doc_url_base, filepath, try_count + 1)
+                    heapq.heappush(self._retries, (time.monotonic() + backoff, next(self._retry_seq), retry_job))
+                    self._retry_added.set()
+                    # job is marked as done by the reaper after it has been put back into the queue
+                    continue
+                self.log.error(f'Could not download {filepath.name}: {e}')
+            except Exception as e:
+                self.log.error(f'Could not download {filepath.name}: {e}')
+            self._queue.task_done()
 
-        with self.history_file.open('a') as history_file:
-            self.log.info('Waiting for downloads to complete..')
-            for future in as_completed(self.futures):
-                if future.filepath.is_file() is True:
-                    self.log.debug(f'file {future.filepath} was already downloaded.')
+    async def _reaper(self):
+        '''
+        put jobs from the retry heap back into the download queue once their retry date is reached
+        '''
+        while True:
+            self._retry_added.clear()
+            if not self._retries:
+                await self._retry_added.wait()
+                continue
 
+            retry_date, _seq, job = self._retries[0]
+            delay = retry_date - time.monotonic()
+            if delay > 0:
                 try:
-                    r = future.result()
-                except Exception as e:
-                    self.log.fatal(str(e))
+                    await asyncio.wait_for(self._retry_added.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._retries)
+            self._queue.put_nowait(job)
+            self._queue.task_done()
+
+    async def _fetch(self, doc_url, doc_url_base, filepath):
+        '''
+        download a single document and add its URL to the history database
+        '''
+        if filepath.is_file() is True:
+            self.log.debug(f'file {filepath} was already downloaded.')
+
+        async with self._http.get(doc_url) as r:
+            r.raise_for_status()
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                async with aiofiles.open(filepath, 'wb') as f:
+                    async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                        await f.write(chunk)
+            except BaseException:
+                # remove partial file, otherwise it would be skipped as already downloaded on the next run
+                filepath.unlink(missing_ok=True)
+                raise
 
-                future.filepath.parent.mkdir(parents=True, exist_ok=True)
-                with open(future.filepath, 'wb') as f:
-                    f.write(r.content)
-                    self.done += 1
-                    history_file.write(f'{future.doc_url_base}\n')
+        self._db.execute('INSERT OR IGNORE INTO downloaded(url) VALUES (?)', (doc_url_base,))
+        self._db.commit()
+        self.done += 1
+        self.log.debug(f'{self.done:>3}/{len(self.doc_urls)} {filepath.name}')
 
-                    self.log.debug(f'{self.done:>3}/{len(self.doc_urls)} {future.filepath.name}')
+    async def _close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        await self._http.close()
+        self._db.close()
+
+    async def work_responses(self):
+        '''
+        wait for the download queue to be processed
+        '''
+        if len(self.doc_urls) == 0:
+            self.log.info('Nothing to download')
+            await self._close()
+            exit(0)
 
-                if self.done == len(self.doc_urls):
-                    self.log.info('Done.')
-                    exit(0)
+        self.log.info('Waiting for downloads to complete..')
+        await self._queue.join()
+        await self._close()
+        self.log.info('Done.')
+        exit(0)
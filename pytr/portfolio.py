@@ -1,4 +1,7 @@
 import asyncio
+import csv
+
+from operator import itemgetter
 
 from pytr.utils import preview
 
@@ -40,8 +43,10 @@ class Portfolio:
 
         # Populate name for each ISIN
         subscriptions = {}
+        # sort once, all following loops and the output use this order
         positions = self.portfolio['positions']
-        for pos in sorted(positions, key=lambda x: x['netSize'], reverse=True):
+        positions.sort(key=itemgetter('netSize'), reverse=True)
+        for pos in positions:
             isin = pos['instrumentId']
             subscription_id = await self.tr.instrument_details(pos['instrumentId'])
             subscriptions[subscription_id] = pos
@@ -60,7 +65,7 @@ class Portfolio:
 
         # Populate netValue for each ISIN
         subscriptions = {}
-        for pos in sorted(positions, key=lambda x: x['netSize'], reverse=True):
+        for pos in positions:
             isin = pos['instrumentId']
             if len(pos['exchangeIds']) > 0:
                 subscription_id = await self.tr.ticker(isin, exchange=pos['exchangeIds'][0])
@@ -81,17 +86,17 @@ class Portfolio:
 
     def portfolio_to_csv(self, output_path):
         positions = self.portfolio['positions']
-        csv_lines = []
-        for pos in sorted(positions, key=lambda x: x['netSize'], reverse=True):
-            csv_lines.append(
-                f"{pos['name']};{pos['instrumentId']};{float(pos['averageBuyIn']):.2f};{float(pos['netValue']):.2f}"
-            )
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write('Name;ISIN;avgCost;netValue\n')
-            f.write('\n'.join(csv_lines))
-        
-        print(f'Wrote {len(csv_lines) + 1} lines to {output_path}')
+        rows = (
+            (pos['name'], pos['instrumentId'], f"{float(pos['averageBuyIn']):.2f}", f"{float(pos['netValue']):.2f}")
+            for pos in positions
+        )
+
+        with open(output_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, delimiter=';', lineterminator='\n')
+            writer.writerow(('Name', 'ISIN', 'avgCost', 'netValue'))
+            writer.writerows(rows)
+
+        print(f'Wrote {len(positions) + 1} lines to {output_path}')
 
     def overview(self):
         # for x in ['netValue', 'unrealisedProfit', 'unrealisedProfitPercent', 'unrealisedCost']:
@@ -104,7 +109,7 @@ class Portfolio:
         totalBuyCost = 0.0
         totalNetValue = 0.0
         positions = self.portfolio['positions']
-        for pos in sorted(positions, key=lambda x: x['netSize'], reverse=True):
+        for pos in positions:
             # pos['netValue'] = 0 # TODO: Update the value from each Stock request
             buyCost = float(pos['averageBuyIn']) * float(pos['netSize'])
             diff = float(pos['netValue']) - buyCost
@@ -1,17 +1,27 @@
 #!/usr/bin/env python3
 
 import coloredlogs
+import csv
+import functools
+import ijson
 import json
 import logging
+import orjson
 import requests
 import re
 import os
 from datetime import datetime
+from itertools import chain
 from locale import getdefaultlocale
 from packaging import version
 
 log_level = None
 
+# write buffer for the exported CSV files
+EXPORT_BUFFER_SIZE = 1 << 20
+# characters removed by clean_strings
+CLEAN_TABLE = str.maketrans('', '', '\n\r')
+
 
 def get_logger(name=__name__, verbosity=None):
     '''
@@ -93,6 +103,131 @@ def check_version(installed_version):
     else:
         log.info('pytr is up to date')
 
+
+# Portfolio Performance labels by language
+PP_I18N = {
+    "date": {
+        "cs": "Datum",
+        "de": "Datum",
+        "en": "Date",
+        "es": "Fecha",
+        "fr": "Date",
+        "it": "Data",
+        "nl": "Datum",
+        "pt": "Data",
+        "ru": "\u0414\u0430\u0442\u0430",
+    },
+    "type": {
+        "cs": "Typ",
+        "de": "Typ",
+        "en": "Type",
+        "es": "Tipo",
+        "fr": "Type",
+        "it": "Tipo",
+        "nl": "Type",
+        "pt": "Tipo",
+        "ru": "\u0422\u0438\u043F",
+    },
+    "value": {
+        "cs": "Hodnota",
+        "de": "Wert",
+        "en": "Value",
+        "es": "Valor",
+        "fr": "Valeur",
+        "it": "Valore",
+        "nl": "Waarde",
+        "pt": "Valor",
+        "ru": "\u0417\u043D\u0430\u0447\u0435\u043D\u0438\u0435",
+    },
+    "deposit": {
+        "cs": 'Vklad',
+        "de": 'Einlage',
+        "en": 'Deposit',
+        "es": 'Dep\u00F3sito',
+        "fr": 'D\u00E9p\u00F4t',
+        "it": 'Deposito',
+        "nl": 'Storting',
+        "pt": 'Dep\u00F3sito',
+        "ru": '\u041F\u043E\u043F\u043E\u043B\u043D\u0435\u043D\u0438\u0435',
+    },
+    "removal": {
+        "cs": 'V\u00FDb\u011Br',
+        "de": 'Entnahme',
+        "en": 'Removal',
+        "es": 'Removal',
+        "fr": 'Retrait',
+        "it": 'Prelievo',
+        "nl": 'Opname',
+        "pt": 'Levantamento',
+        "ru": '\u0421\u043F\u0438\u0441\u0430\u043D\u0438\u0435',
+    },
+    "interest": {
+        "cs": 'Úrokové poplatky',
+        "de": 'Zinsen',
+        "en": 'Interest',
+        "es": 'Interés',
+        "fr": 'L\'intérêts',
+        "it": 'Interessi',
+        "nl": 'Interest',
+        "pt": 'Odsetki',
+        "ru": '\u041f\u0440\u043e\u0446\u0435\u0301\u043d\u0442\u044b',
+    },
+    "card transaction": {
+        "cs": 'Platba kartou',
+        "de": 'Kartentransaktion',
+        "en": 'Card Transaction',
+        "es": 'Transacción con tarjeta',
+        "fr": 'Transaction par carte',
+        "it": 'Transazione con carta',
+        "nl": 'Kaarttransactie',
+        "pt": 'Transakcja kartą',
+        "ru": '\u041e\u043f\u0435\u0440\u0430\u0446\u0438\u044f\u0020\u043f\u043e\u0020\u043a\u0430\u0440\u0442\u0435',
+    },
+    "decimal dot": {
+        "cs": ',',
+        "de": ',',
+        "en": '.',
+        "es": ',',
+        "fr": ',',
+        "it": ',',
+        "nl": ',',
+        "pt": ',',
+        "ru": ',',
+    },
+}
+
+
+# languages with translations for all PP_I18N keys
+PP_LANGUAGES = frozenset.intersection(*(frozenset(translations) for translations in PP_I18N.values()))
+# event type -> PP_I18N key of the transaction type
+PP_EVENT_TYPES = {
+    "PAYMENT_INBOUND": "deposit",
+    "PAYMENT_INBOUND_SEPA_DIRECT_DEBIT": "deposit",
+    "PAYMENT_OUTBOUND": "removal",
+    "INTEREST_PAYOUT_CREATED": "interest",
+    "card_successful_transaction": "card transaction",
+}
+
+
+@functools.lru_cache(maxsize=1)
+def auto_lang():
+    '''
+    Two letter language code of the system locale, 'en' if it is not set (cached)
+    '''
+    locale = getdefaultlocale()[0]
+    if locale is None:
+        return 'en'
+    return locale.split('_')[0]
+
+
+@functools.lru_cache(maxsize=None)
+def pp_labels(lang):
+    '''
+    Portfolio Performance labels translated to lang (cached)
+    '''
+    return {key: translations[lang] for key, translations in PP_I18N.items()}
+
+
 def export_transactions(input_path, output_path, lang='auto'):
     '''
     Create a CSV with the deposits and removals ready for importing into Portfolio Performance
@@ -105,152 +240,113 @@ def export_transactions(input_path, output_path, lang='auto'):
     '''
     log = get_logger(__name__)
     if lang == 'auto':
-        locale = getdefaultlocale()[0]
-        if locale is None:
-            lang = 'en'
-        else:
-            lang = locale.split('_')[0]
+        lang = auto_lang()
 
-    if lang not in ['cs', 'de', 'en', 'es', 'fr', 'it', 'nl', 'pt', 'ru']:
+    if lang not in PP_LANGUAGES:
         lang = 'en'
 
-    i18n = {
-        "date": {
-            "cs": "Datum",
-            "de": "Datum",
-            "en": "Date",
-            "es": "Fecha",
-            "fr": "Date",
-            "it": "Data",
-            "nl": "Datum",
-            "pt": "Data",
-            "ru": "\u0414\u0430\u0442\u0430",
-        },
-        "type": {
-            "cs": "Typ",
-            "de": "Typ",
-            "en": "Type",
-            "es": "Tipo",
-            "fr": "Type",
-            "it": "Tipo",
-            "nl": "Type",
-            "pt": "Tipo",
-            "ru": "\u0422\u0438\u043F",
-        },
-        "value": {
-            "cs": "Hodnota",
-            "de": "Wert",
-            "en": "Value",
-            "es": "Valor",
-            "fr": "Valeur",
-            "it": "Valore",
-            "nl": "Waarde",
-            "pt": "Valor",
-            "ru": "\u0417\u043D\u0430\u0447\u0435\u043D\u0438\u0435",
-        },
-        "deposit": {
-            "cs": 'Vklad',
-            "de": 'Einlage',
-            "en": 'Deposit',
-            "es": 'Dep\u00F3sito',
-            "fr": 'D\u00E9p\u00F4t',
-            "it": 'Deposito',
-            "nl": 'Storting',
-            "pt": 'Dep\u00F3sito',
-            "ru": '\u041F\u043E\u043F\u043E\u043B\u043D\u0435\u043D\u0438\u0435',
-        },
-        "removal": {
-            "cs": 'V\u00FDb\u011Br',
-            "de": 'Entnahme',
-            "en": 'Removal',
-            "es": 'Removal',
-            "fr": 'Retrait',
-            "it": 'Prelievo',
-            "nl": 'Opname',
-            "pt": 'Levantamento',
-            "ru": '\u0421\u043F\u0438\u0441\u0430\u043D\u0438\u0435',
-        },
-        "interest": {
-            "cs": 'Úrokové poplatky',
-            "de": 'Zinsen',
-            "en": 'Interest',
-            "es": 'Interés',
-            "fr": 'L\'intérêts',
-            "it": 'Interessi',
-            "nl": 'Interest',
-            "pt": 'Odsetki',
-            "ru": '\u041f\u0440\u043e\u0446\u0435\u0301\u043d\u0442\u044b',
-        },
-        "card transaction": {
-            "cs": 'Platba kartou',
-            "de": 'Kartentransaktion',
-            "en": 'Card Transaction',
-            "es": 'Transacción con tarjeta',
-            "fr": 'Transaction par carte',
-            "it": 'Transazione con carta',
-            "nl": 'Kaarttransactie',
-            "pt": 'Transakcja kartą',
-            "ru": '\u041e\u043f\u0435\u0440\u0430\u0446\u0438\u044f\u0020\u043f\u043e\u0020\u043a\u0430\u0440\u0442\u0435',
-        },
-        "decimal dot": {
-            "cs": ',',
-            "de": ',',
-            "en": '.',
-            "es": ',',
-            "fr": ',',
-            "it": ',',
-            "nl": ',',
-            "pt": ',',
-            "ru": ',',
-        },
-    }
+    labels = pp_labels(lang)
+
     # Read relevant deposit timeline entries
-    with open(input_path, encoding='utf-8') as f:
-        timeline = json.load(f)
+    with open(input_path, 'rb') as f:
+        timeline = orjson.loads(f.read())
 
     # Write deposit_transactions.csv file
     # date, transaction, shares, amount, total, fee, isin, name
     log.info('Write deposit entries')
-    with open(output_path, 'w', encoding='utf-8') as f:
+    with open(output_path, 'w', newline='', encoding='utf-8', buffering=EXPORT_BUFFER_SIZE) as f:
         # f.write('Datum;Typ;Stück;amount;Wert;Gebühren;ISIN;name\n')
-        csv_fmt = '{date};{type};{value}\n'
-        header = csv_fmt.format(date=i18n['date'][lang], type=i18n['type'][lang], value=i18n['value'][lang])
-        f.write(header)
+        writer = csv.writer(f, delimiter=';', lineterminator='\n')
+        writer.writerow((labels['date'], labels['type'], labels['value']))
+        writer.writerows(_transaction_rows(timeline, labels, log))
 
-        for event in timeline:
-            dateTime = datetime.fromisoformat(event['timestamp'][:19])
-            date = dateTime.strftime('%Y-%m-%d')
+    log.info('Deposit creation finished!')
 
-            title = event['title']
-            try:
-                body = event['body']
-            except KeyError:
-                body = ''
 
-            if 'storniert' in body:
-                continue
+def _transaction_rows(timeline, labels, log):
+    decdot = labels['decimal dot']
+    if decdot == '.':
+        # nothing to localize
+        format_amount = str
+    else:
+        decimal_table = str.maketrans('.', decdot)
 
-            try:
-                decdot = i18n['decimal dot'][lang]
-                amount = str(abs(event['amount']['value'])).replace('.', decdot)
-            except (KeyError, TypeError):
-                continue
+        def format_amount(value):
+            return str(value).translate(decimal_table)
 
-            # Cash in
-            if event["eventType"] in ("PAYMENT_INBOUND", "PAYMENT_INBOUND_SEPA_DIRECT_DEBIT"):
-                f.write(csv_fmt.format(date=date, type=i18n['deposit'][lang], value=amount))
-            elif event["eventType"] == "PAYMENT_OUTBOUND":
-                f.write(csv_fmt.format(date=date, type=i18n['removal'][lang], value=amount))
-            elif event["eventType"] == "INTEREST_PAYOUT_CREATED":
-                f.write(csv_fmt.format(date=date, type=i18n['interest'][lang], value=amount))
-            # Dividend - Shares
-            elif title == 'Reinvestierung':
-                # TODO: Implement reinvestment
-                log.warning('Detected reivestment, skipping... (not implemented yet)')
-            elif event["eventType"] == "card_successful_transaction":
-                f.write(csv_fmt.format(date=date, type=i18n['card transaction'][lang], value=amount))
+    type_labels = {event_type: labels[key] for event_type, key in PP_EVENT_TYPES.items()}
+
+    for event in timeline:
+        # ISO 8601 timestamps start with YYYY-MM-DD
+        date = event['timestamp'][:10]
+
+        title = event['title']
+        try:
+            body = event['body']
+        except KeyError:
+            body = ''
+
+        if 'storniert' in body:
+            continue
+
+        try:
+            amount = format_amount(abs(event['amount']['value']))
+        except (KeyError, TypeError):
+            continue
+
+        type_label = type_labels.get(event["eventType"])
+        if type_label is not None:
+            yield (date, type_label, amount)
+        # Dividend - Shares
+        elif title == 'Reinvestierung':
+            # TODO: Implement reinvestment
+            log.warning('Detected reivestment, skipping... (not implemented yet)')
+
+
+def _banking4_title(title, body):
+    return title
+
+
+def _banking4_title_with_body(title, body):
+    return clean_strings(title + ": " + body)
+
+
+# handlers for events matched by their exact title
+BANKING4_TITLE_HANDLERS = {
+    'Einzahlung': _banking4_title_with_body,
+    'Bonuszahlung': _banking4_title_with_body,
+    'Steuerabrechnung': _banking4_title_with_body,
+    'Auszahlung': _banking4_title,
+}
+BANKING4_TITLE_RE = re.compile(r'\b(VERDIENTE\sZINSEN|Vorabpauschale)\b', re.IGNORECASE)
+BANKING4_BODY_RE = re.compile(r'\b(Ausschüttung|Dividende\spro\s|Sparplan\sausgeführt|Kauf\s|Verkauf)')
+
+
+def _banking4_rows(events, log):
+    for event in events:
+        event = event['data']
+        date = datetime.fromtimestamp(event['timestamp'] // 1000).date().isoformat()
+
+        title = event['title']
+        try:
+            body = event['body']
+        except KeyError:
+            body = ''
+
+        if 'storniert' in body:
+            continue
+
+        handler = BANKING4_TITLE_HANDLERS.get(title)
+        if handler is None and (BANKING4_TITLE_RE.search(title) or BANKING4_BODY_RE.search(body)):
+            handler = _banking4_title_with_body
+
+        if handler is not None:
+            yield (date, handler(title, body), event['cashChangeAmount'])
+        # Dividend - Shares
+        elif title == 'Reinvestierung':
+            # TODO: Implement reinvestment
+            log.warning('Detected reivestment, skipping... (not implemented yet)')
 
-    log.info('Deposit creation finished!')
 
 def export_banking4(input_path, output_path, lang='auto'):
     '''
@@ -258,62 +354,49 @@ def export_banking4(input_path, output_path, lang='auto'):
     '''
     log = get_logger(__name__)
     if lang == 'auto':
-        locale = getdefaultlocale()[0]
-        if locale is None:
-            lang = 'en'
-        else:
-            lang = locale.split('_')[0]
+        lang = auto_lang()
     #Build Strings
     timeline1_loc = os.path.join(input_path,"other_events.json")
     timeline2_loc = os.path.join(input_path,"events_with_documents.json")
 
-    # Read relevant deposit timeline entries
-    with open(timeline1_loc, encoding='utf-8') as f:
-        timeline1 = json.load(f)
-    with open(timeline2_loc, encoding='utf-8') as f:
-        timeline2 = json.load(f)    
+    # Stream relevant deposit timeline entries, the events are parsed while the CSV is written
+    with open(timeline1_loc, 'rb') as timeline1, open(timeline2_loc, 'rb') as timeline2:
+        events = chain(ijson.items(timeline1, 'item', use_float=True), ijson.items(timeline2, 'item', use_float=True))
 
-    # Write deposit_transactions.csv file
-    # date, transaction, shares, amount, total, fee, isin, name
-    log.info('Write transaction entries')
-    with open(output_path, 'w', encoding='utf-8') as f:
-        # f.write('Datum;Typ;Stück;amount;Wert;Gebühren;ISIN;name\n')
-        csv_fmt = '{date};{type};{value}\n'
-        header = csv_fmt.format(date='date', type='type', value='value')
-        f.write(header)
+        # Write deposit_transactions.csv file
+        # date, transaction, shares, amount, total, fee, isin, name
+        log.info('Write transaction entries')
+        with open(output_path, 'w', newline='', encoding='utf-8', buffering=EXPORT_BUFFER_SIZE) as f:
+            # f.write('Datum;Typ;Stück;amount;Wert;Gebühren;ISIN;name\n')
+            writer = csv.writer(f, delimiter=';', lineterminator='\n')
+            writer.writerow(('date', 'type', 'value'))
+            writer.writerows(_banking4_rows(events, log))
 
-        for event in timeline1+timeline2:
-            event = event['data']
-            dateTime = datetime.fromtimestamp(int(event['timestamp'] / 1000))
-            date = dateTime.strftime('%Y-%m-%d')
+    log.info('transaction creation finished!')
 
-            title = event['title']
-            try:
-                body = event['body']
-            except KeyError:
-                body = ''
+def dump_json(obj):
+    '''
+    Serialize obj to indented UTF-8 JSON with orjson.
+    Falls back to the json module for payloads orjson rejects, e.g. integers beyond 64 bit.
+    '''
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
 
-            if 'storniert' in body:
-                continue
 
-            # Cash in
-            if title in ['Einzahlung', 'Bonuszahlung','Steuerabrechnung']:
-                f.write(csv_fmt.format(date=date, type=clean_strings(title+": "+body), value=event['cashChangeAmount']))
-            elif title == 'Auszahlung':
-                f.write(csv_fmt.format(date=date, type=title, value=event['cashChangeAmount']))
-            elif bool(re.search(r'\b(VERDIENTE\sZINSEN|Vorabpauschale)\b', title, re.IGNORECASE)):
-                f.write(csv_fmt.format(date=date, type=clean_strings(title+": "+body), value=event['cashChangeAmount']))  
-            elif bool(re.search(r'\b(Ausschüttung|Dividende\spro\s|Sparplan\sausgeführt|Kauf\s|Verkauf)', body)):
-                f.write(csv_fmt.format(date=date, type=clean_strings(title+": "+body), value=event['cashChangeAmount'])) 
-            # Dividend - Shares
-            elif title == 'Reinvestierung':
-                # TODO: Implement reinvestment
-                log.warning('Detected reivestment, skipping... (not implemented yet)')
+def clean_strings(text: str):
+    return text.translate(CLEAN_TABLE)
 
-    log.info('transaction creation finished!')
 
-def clean_strings(text: str):
-    return text.replace("\n", "")
+# subfolders for documents of these event types
+EVENT_TYPE_SUBFOLDERS = {
+    'benefits_saveback_execution': 'Saveback',
+    'benefits_spare_change_execution': 'RoundUp',
+    'INTEREST_PAYOUT_CREATED': 'Zinsen',
+}
+# event types with the subtitle added to the document title
+ACCOUNT_TRANSFER_EVENT_TYPES = frozenset({'ACCOUNT_TRANSFER_INCOMING', 'ACCOUNT_TRANSFER_OUTGOING'})
 
 
 class Timeline:
@@ -438,7 +521,9 @@ class Timeline:
                 self.events_with_docs.append(event)
             else:
                 self.events_without_docs.append(event)
-                self.log.debug(f"{msg} {event['title']}: {event.get('body')} {json.dumps(event)}")
+                # serializing the whole event is expensive, only do it when it is actually logged
+                if self.log.isEnabledFor(logging.DEBUG):
+                    self.log.debug(f"{msg} {event['title']}: {event.get('body')} {json.dumps(event)}")
                 self.num_timeline_details -= 1
                 continue
 
@@ -463,27 +548,31 @@ class Timeline:
             else:
                 await self._get_timeline_details(5)
 
-        isSavingsPlan = (event["eventType"] == "SAVINGS_PLAN_EXECUTED")
+        event_type = event["eventType"]
+        event_title = event['title']
+        event_subtitle = event['subtitle']
+        isSavingsPlan = (event_type == "SAVINGS_PLAN_EXECUTED")
 
         isSavingsPlan_fmt = ''
-        if not isSavingsPlan and event['subtitle'] is not None:
-            isSavingsPlan = 'Sparplan' in event['subtitle']
+        if not isSavingsPlan and event_subtitle is not None:
+            isSavingsPlan = 'Sparplan' in event_subtitle
             isSavingsPlan_fmt = ' -- SPARPLAN' if isSavingsPlan else ''
 
         max_details_digits = len(str(self.num_timeline_details))
         self.log.info(
             f"{self.received_detail:>{max_details_digits}}/{self.num_timeline_details}: "
-            + f"{event['title']} -- {event['subtitle']}{isSavingsPlan_fmt}"
+            + f"{event_title} -- {event_subtitle}{isSavingsPlan_fmt}"
         )
 
         if isSavingsPlan:
             subfolder = 'Sparplan'
         else:
-            subfolder = {
-                'benefits_saveback_execution': 'Saveback',
-                'benefits_spare_change_execution': 'RoundUp',
-                'INTEREST_PAYOUT_CREATED': 'Zinsen',
-            }.get(event["eventType"])
+            subfolder = EVENT_TYPE_SUBFOLDERS.get(event_type)
+
+        # the part of the document title that comes from the event is the same for all its documents
+        title_suffix = f" - {event_title}"
+        if event_type in ACCOUNT_TRANSFER_EVENT_TYPES:
+            title_suffix += f" - {event_subtitle}"
 
         for section in response['sections']:
             if section['type'] == 'documents':
@@ -494,20 +583,14 @@ class Timeline:
                         timestamp = datetime.now().timestamp() * 1000
                     if max_age_timestamp == 0 or max_age_timestamp < timestamp:
                         # save all savingsplan documents in a subdirectory
-                        title = f"{doc['title']} - {event['title']}"
-                        if event['eventType'] in ["ACCOUNT_TRANSFER_INCOMING", "ACCOUNT_TRANSFER_OUTGOING"]:
-                            title += f" - {event['subtitle']}"
-                        dl.dl_doc(doc, title, doc.get('detail'), subfolder)
+                        dl.dl_doc(doc, f"{doc['title']}{title_suffix}", doc.get('detail'), subfolder)
 
         if self.received_detail == self.num_timeline_details:
             self.log.info('Received all details')
             dl.output_path.mkdir(parents=True, exist_ok=True)
-            with open(dl.output_path / 'other_events.json', 'w', encoding='utf-8') as f:
-                json.dump(self.events_without_docs, f, ensure_ascii=False, indent=2)
-
-            with open(dl.output_path / 'events_with_documents.json', 'w', encoding='utf-8') as f:
-                json.dump(self.events_with_docs, f, ensure_ascii=False, indent=2)
+            (dl.output_path / 'other_events.json').write_bytes(dump_json(self.events_without_docs))
+            (dl.output_path / 'events_with_documents.json').write_bytes(dump_json(self.events_with_docs))
 
             export_transactions(dl.output_path / 'events_with_documents.json', dl.output_path / 'account_transactions.csv')
 
-            dl.work_responses()
+            await dl.work_responses()
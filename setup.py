@@ -28,13 +28,17 @@ setup(
     #  scripts=['traderep'],
     # install_requires=['py_tr'],
     install_requires=[
+        'aiofiles',
+        'aiohttp',
         'certifi',
         'coloredlogs',
         'ecdsa',
+        'ijson>=3.1',
+        'orjson',
         'packaging',
         'pathvalidate',
         'pygments',
-        'requests_futures',
+        'requests',
         'shtab',
         'websockets>=10.1',
     ],